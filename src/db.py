@@ -1,74 +1,232 @@
+import logging
 import os
-import queue
 import threading
+import time
+from collections import deque
 from contextlib import contextmanager
-import pymysql
 from dotenv import load_dotenv
 
+# prefer mysqlclient (C implementation) when installed; both are DB-API drivers with the same %s paramstyle
+try:
+    import MySQLdb as mysql_driver
+    import MySQLdb.cursors
+    _driver_options = {}
+except ImportError:
+    import pymysql as mysql_driver
+    import pymysql.cursors
+    # send bytes parameters (api keys) as _binary'...' literals, as mysqlclient already does,
+    # instead of plain strings that are usually invalid utf8mb4
+    _driver_options = {'binary_prefix': True}
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 MYSQL_HOST = os.getenv('MYSQL_HOST', 'mysql.railway.internal')
 MYSQL_PORT = int(os.getenv('MYSQL_PORT', '3306'))
 MYSQL_USER = os.getenv('MYSQL_USER', 'root')
 MYSQL_PASSWORD = os.getenv('MYSQL_PASSWORD', 'BbVIcArOMINDXbUyuEkhrflgFDtvzwve')
 MYSQLDATABASE = os.getenv('MYSQLDATABASE', 'bootstrapper')
 POOL_MIN = int(os.getenv('POOL_MIN_CONN', '1'))
-POOL_MAX = int(os.getenv('POOL_MAX_CONN', '5'))
+# default size follows the HikariCP formula: (cores * 2) + effective spindles
+POOL_MAX = int(os.getenv('POOL_MAX_CONN') or ((os.cpu_count() or 1) * 2 + 1))
+# hard ceiling on connections open at once. Between POOL_MAX and this, bursts get short-lived
+# overflow connections that are closed as soon as they are released; defaults to no overflow
+POOL_MAX_OVERFLOW = int(os.getenv('POOL_MAX_OVERFLOW') or POOL_MAX)
+if POOL_MAX_OVERFLOW < POOL_MAX:
+    raise ValueError(f'POOL_MAX_OVERFLOW ({POOL_MAX_OVERFLOW}) must be at least POOL_MAX_CONN ({POOL_MAX})')
+POOL_TIMEOUT = float(os.getenv('POOL_TIMEOUT', '5'))
+# idle connections older than this are closed instead of reused (keep below MySQL's wait_timeout)
+POOL_IDLE_TIMEOUT = float(os.getenv('POOL_IDLE_TIMEOUT', '60'))
+# idle connections older than this are pinged before being handed out
+POOL_PING_AFTER = float(os.getenv('POOL_PING_AFTER', '30'))
+POOL_REAP_INTERVAL = float(os.getenv('POOL_REAP_INTERVAL', '30'))
 
 _pool_lock = threading.Lock()
-_pool = None
+_pool_cond = threading.Condition(_pool_lock)
+_pool = None  # idle (conn, last_used) pairs, most recently released at the right end
+_created = 0  # connections owned by the pool (idle + checked out), guarded by _pool_lock
+_overflow = 0  # overflow connections currently checked out, guarded by _pool_lock
+_waiting = 0  # threads blocked waiting for a connection, guarded by _pool_lock
+_reaper = None
+
+
+class PoolTimeout(Exception):
+    """No connection became available within POOL_TIMEOUT."""
 
 
 def _create_connection():
-    return pymysql.connect(host=MYSQL_HOST,
-                           port=MYSQL_PORT,
-                           user=MYSQL_USER,
-                           password=MYSQL_PASSWORD,
-                           db=MYSQLDATABASE,
-                           charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor,
-                           autocommit=False)
+    return mysql_driver.connect(host=MYSQL_HOST,
+                                port=MYSQL_PORT,
+                                user=MYSQL_USER,
+                                password=MYSQL_PASSWORD,
+                                db=MYSQLDATABASE,
+                                charset='utf8mb4',
+                                cursorclass=mysql_driver.cursors.DictCursor,
+                                # reads never leave a transaction (and its snapshot) open on a pooled connection
+                                autocommit=True,
+                                **_driver_options)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _is_usable(conn, idle_for):
+    if idle_for > POOL_IDLE_TIMEOUT:
+        return False
+    if idle_for > POOL_PING_AFTER:
+        try:
+            # no keyword: mysqlclient only takes reconnect positionally, pymysql reconnects by default
+            conn.ping()
+        except Exception:
+            return False
+    return True
+
+
+def pool_stats():
+    with _pool_lock:
+        idle = len(_pool) if _pool is not None else 0
+        return {'size': _created, 'idle': idle, 'in_use': _created - idle + _overflow,
+                'overflow': _overflow, 'waiting': _waiting}
+
+
+def _reap_idle():
+    """Background loop closing connections idle for longer than POOL_IDLE_TIMEOUT and logging pool stats."""
+    global _created
+    while True:
+        time.sleep(POOL_REAP_INTERVAL)
+        expired = []
+        with _pool_cond:
+            cutoff = time.monotonic() - POOL_IDLE_TIMEOUT
+            # LIFO checkout leaves the coldest connections at the left end
+            while _pool and _pool[0][1] < cutoff:
+                expired.append(_pool.popleft()[0])
+            _created -= len(expired)
+        for conn in expired:
+            _close_quietly(conn)
+        logger.info("db pool: size=%(size)d idle=%(idle)d in_use=%(in_use)d overflow=%(overflow)d waiting=%(waiting)d",
+                    pool_stats())
 
 
 def init_pool():
-    global _pool
+    global _pool, _created, _reaper
     with _pool_lock:
         if _pool is not None:
             return
-        q = queue.Queue(maxsize=POOL_MAX)
-        for _ in range(POOL_MIN):
-            q.put(_create_connection())
-        _pool = q
+        idle = deque()
+        now = time.monotonic()
+        for _ in range(min(POOL_MIN, POOL_MAX)):
+            idle.append((_create_connection(), now))
+        _created = len(idle)
+        _pool = idle
+        _reaper = threading.Thread(target=_reap_idle, name='db-pool-reaper', daemon=True)
+        _reaper.start()
+
+
+def _acquire():
+    """Check out a connection, returning (conn, pooled); raise PoolTimeout if none frees up in time.
+
+    Idle connections are handed out LIFO so a small hot set stays in use while
+    the rest sit idle at the left end. Below POOL_MAX a new connection is opened
+    instead of waiting, and a checked out connection that has gone stale is
+    replaced by a fresh one. Once POOL_MAX is reached, unpooled connections are
+    opened until POOL_MAX_OVERFLOW connections are open in total; then callers wait.
+    """
+    global _created, _overflow, _waiting
+    conn = None
+    pooled = True
+    deadline = time.monotonic() + POOL_TIMEOUT
+    with _pool_cond:
+        while not _pool:
+            if _created < POOL_MAX:
+                _created += 1
+                break
+            if _created + _overflow < POOL_MAX_OVERFLOW:
+                _overflow += 1
+                pooled = False
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolTimeout(f'no database connection available after {POOL_TIMEOUT}s')
+            _waiting += 1
+            try:
+                _pool_cond.wait(remaining)
+            finally:
+                _waiting -= 1
+        else:
+            conn, last_used = _pool.pop()
+    if conn is not None:
+        if _is_usable(conn, time.monotonic() - last_used):
+            return conn, True
+        _close_quietly(conn)
+    # open the new connection outside the lock so other threads are not held up
+    try:
+        return _create_connection(), pooled
+    except Exception:
+        with _pool_cond:
+            if pooled:
+                _created -= 1
+            else:
+                _overflow -= 1
+            _pool_cond.notify()
+        raise
+
+
+def _release(conn):
+    with _pool_cond:
+        _pool.append((conn, time.monotonic()))
+        _pool_cond.notify()
+
+
+def _discard(conn):
+    global _created
+    with _pool_cond:
+        _created -= 1
+        _pool_cond.notify()
+    _close_quietly(conn)
+
+
+def _release_overflow(conn):
+    global _overflow
+    with _pool_cond:
+        _overflow -= 1
+        _pool_cond.notify()
+    _close_quietly(conn)
 
 
 @contextmanager
 def get_conn():
+    """Check out a connection in autocommit mode.
+
+    Single statements commit on their own; multi-statement writes that must be
+    atomic go between conn.begin() and conn.commit(). A transaction left open
+    by an exception is rolled back before the connection returns to the pool.
+    """
     global _pool
     if _pool is None:
         init_pool()
-    try:
-        conn = _pool.get(block=True, timeout=5)
-    except Exception:
-        # fallback to direct connection
-        conn = _create_connection()
-        borrowed = False
-    else:
-        borrowed = True
+    conn, pooled = _acquire()
     try:
         yield conn
+    except BaseException:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
     finally:
         try:
-            if borrowed:
+            if not pooled:
+                _release_overflow(conn)
+            elif conn.open:
                 # return connection to pool if still open
-                if conn.open:
-                    _pool.put(conn)
-                else:
-                    # replace dead connection
-                    _pool.put(_create_connection())
+                _release(conn)
             else:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
+                # drop dead connection, the pool regrows on demand
+                _discard(conn)
         except Exception:
             pass
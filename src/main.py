@@ -3,24 +3,54 @@ from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+import logging
 import os
 
-from db import init_pool
+from db import init_pool, PoolTimeout, logger as db_logger
 from services import (
-    create_user, get_user_by_api_key, ensure_usage_row,
-    increment_call_and_check_limit, increment_project_and_check_limit,
+    create_user, get_cached_user, get_user_by_api_key, ensure_usage_row,
     create_preset, list_presets, get_preset, update_preset, delete_preset
 )
-from utils import create_zip_archive, ALLOWED_FREE_TEMPLATES, generate_api_key
+from ratelimit import (
+    increment_call_and_check_limit, increment_project_and_check_limit,
+    start_usage_flusher, flush_usage, logger as ratelimit_logger
+)
+from utils import build_project_zip, render_template, ALLOWED_FREE_TEMPLATES, generate_api_key
 from contextlib import asynccontextmanager
 
+def _configure_logging():
+    # uvicorn only sets up its own loggers; without this pool stats and flush errors are dropped
+    uvicorn_handlers = logging.getLogger('uvicorn.error').handlers
+    for logger in (db_logger, ratelimit_logger):
+        if logger.handlers:
+            continue
+        if uvicorn_handlers:
+            for handler in uvicorn_handlers:
+                logger.addHandler(handler)
+        else:
+            logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    _configure_logging()
     init_pool()
+    start_usage_flusher()
     yield
+    flush_usage()
 
 app = FastAPI(title="Project Bootstrapper API (Free Tier)", lifespan=lifespan)
 
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    # every database connection is busy; tell the client to retry instead of queueing forever
+    return JSONResponse(status_code=503, content={'detail': 'Service busy, try again later'},
+                        headers={'Retry-After': '1'})
+
+
 # read limits from env
 DAILY_LIMIT = int(os.getenv('API_RATE_LIMIT_PER_DAY', '10'))
 MONTH_LIMIT = int(os.getenv('API_PROJECTS_PER_MONTH', '5'))
@@ -41,7 +71,8 @@ class PresetIn(BaseModel):
 
 
 class CreateRequest(BaseModel):
-    name: str
+    # a single safe path component: it names a folder inside the zip and the download file
+    name: str = Field(..., max_length=100, pattern=r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
     template: str
     git_init: Optional[bool] = False
     use_venv: Optional[bool] = False
@@ -50,7 +81,7 @@ class CreateRequest(BaseModel):
 
 # ---- dependencies ----
 @app.get("/", response_class=HTMLResponse)
-def home():
+async def home():
     return """
     <html>
     <head>
@@ -111,14 +142,24 @@ Content-Type: application/json
     </html>
     """
 
-def require_api_key(x_api_key: Optional[str] = Header(None)):
+async def _check_limit(check, user_id: int, limit: int) -> bool:
+    # answer from memory on the event loop when possible, otherwise do the I/O on the thread pool
+    ok = check(user_id, limit, load=False)
+    if ok is None:
+        ok = await run_in_threadpool(check, user_id, limit)
+    return ok
+
+
+async def require_api_key(x_api_key: Optional[str] = Header(None)):
     if not x_api_key:
         raise HTTPException(status_code=401, detail='Missing X-API-Key header')
-    user = get_user_by_api_key(x_api_key)
+    user = get_cached_user(x_api_key)
+    if not user:
+        user = await run_in_threadpool(get_user_by_api_key, x_api_key)
     if not user:
         raise HTTPException(status_code=401, detail='Invalid API key')
     # enforce daily call limit
-    ok = increment_call_and_check_limit(user['id'], DAILY_LIMIT)
+    ok = await _check_limit(increment_call_and_check_limit, user['id'], DAILY_LIMIT)
     if not ok:
         raise HTTPException(status_code=429, detail='Daily API call limit exceeded')
     return user
@@ -131,13 +172,15 @@ def register_user(payload: UserCreate):
     api_key = generate_api_key()
     try:
         user = create_user(payload.username, payload.email, api_key)
+    except PoolTimeout:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     return {k: user[k] for k in user}
 
 
 @app.get('/templates')
-def list_templates(user=Depends(require_api_key)):
+async def list_templates(user=Depends(require_api_key)):
     # only free templates available
     return {'available_templates': list(ALLOWED_FREE_TEMPLATES)}
 
@@ -159,7 +202,10 @@ def get_presets(user=Depends(require_api_key)):
 def put_preset(preset_id: int, payload: PresetIn, user=Depends(require_api_key)):
     if payload.template not in ALLOWED_FREE_TEMPLATES:
         raise HTTPException(status_code=403, detail='Template not allowed for free tier')
-    updated = update_preset(user['id'], preset_id, payload.dict())
+    try:
+        updated = update_preset(user['id'], preset_id, payload.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not updated:
         raise HTTPException(status_code=404, detail='Preset not found')
     return updated
@@ -174,59 +220,33 @@ def remove_preset(preset_id: int, user=Depends(require_api_key)):
 
 
 @app.post('/create')
-def create_project(req: CreateRequest, download: Optional[bool] = False, background_tasks: BackgroundTasks = None, user=Depends(require_api_key)):
+async def create_project(req: CreateRequest, download: Optional[bool] = False, background_tasks: BackgroundTasks = None, user=Depends(require_api_key)):
     # template check
     if req.template not in ALLOWED_FREE_TEMPLATES:
         raise HTTPException(status_code=403, detail='Template not allowed for free tier')
     # check monthly project limit
-    ok = increment_project_and_check_limit(user['id'], MONTH_LIMIT)
+    ok = await _check_limit(increment_project_and_check_limit, user['id'], MONTH_LIMIT)
     if not ok:
         raise HTTPException(status_code=429, detail='Monthly project limit exceeded')
 
-    # create project folder in tmp
-    import tempfile, pathlib
-    project_root = pathlib.Path(tempfile.mkdtemp(prefix='proj_'))
-    try:
-        # write basic files according to template
-        if req.template == 'basic-python':
-            (project_root / req.name).mkdir(parents=True, exist_ok=True)
-            (project_root / req.name / '__init__.py').write_text('')
-            (project_root / 'README.md').write_text(f"# {req.name}\nGenerated by bootstrapper\n")
-            (project_root / 'main.py').write_text('print("Hello from generated project")')
-        elif req.template == 'flask':
-            (project_root / req.name).mkdir(parents=True, exist_ok=True)
-            (project_root / req.name / 'app.py').write_text('from flask import Flask\napp = Flask(__name__)\n\n@app.route("/")\ndef home():\n    return "Hello, Flask!"\n')
-            (project_root / 'requirements.txt').write_text('flask')
-        elif req.template == 'fastapi':
-            (project_root / 'app').mkdir(parents=True, exist_ok=True)
-            (project_root / 'app' / 'main.py').write_text('from fastapi import FastAPI\napp=FastAPI()\n@app.get("/")\ndef root():\n    return {"msg":"Hello FastAPI"}')
-            (project_root / 'requirements.txt').write_text('fastapi\nuvicorn')
-        # optional git init / venv flags are ignored for free tier (blocked features)
-
-        if download:
-            data = create_zip_archive(str(project_root))
-            return Response(content=data, media_type='application/zip', headers={
-                'Content-Disposition': f'attachment; filename="{req.name}.zip"'
-            })
-        else:
-            # return a simple manifest
-            files = [str(p.relative_to(project_root)) for p in project_root.rglob('*') if p.is_file()]
-            return {'project_name': req.name, 'files': files}
-    finally:
-        # cleanup
-        import shutil
-        try:
-            shutil.rmtree(project_root)
-        except Exception:
-            pass
+    # the file set is fully determined by the template, so nothing touches the filesystem
+    # optional git init / venv flags are ignored for free tier (blocked features)
+
+    if download:
+        return Response(content=build_project_zip(req.template, req.name), media_type='application/zip', headers={
+            'Content-Disposition': f'attachment; filename="{req.name}.zip"'
+        })
+    else:
+        # return a simple manifest
+        return {'project_name': req.name, 'files': [path for path, _ in render_template(req.template, req.name)]}
 
 
 @app.post('/create-and-download')
-def create_and_download(req: CreateRequest, user=Depends(require_api_key)):
+async def create_and_download(req: CreateRequest, user=Depends(require_api_key)):
     # convenience wrapper
-    return create_project(req, download=True, user=user)
+    return await create_project(req, download=True, user=user)
 
 
 @app.get('/health')
-def health():
+async def health():
     return {'status': 'ok'}
@@ -0,0 +1,11 @@
+-- Store API keys as their 16 raw bytes instead of 36-char UUID strings.
+-- Keys issued before this migration keep working: the API decodes a UUID key
+-- to the same 16 bytes UNHEX produces here.
+USE bootstrapper;
+
+ALTER TABLE users ADD COLUMN api_key_bin BINARY(16) NULL AFTER api_key;
+UPDATE users SET api_key_bin = UNHEX(REPLACE(api_key, '-', ''));
+ALTER TABLE users DROP COLUMN api_key;
+ALTER TABLE users
+    CHANGE api_key_bin api_key BINARY(16) NOT NULL,
+    ADD UNIQUE KEY ux_users_api_key (api_key);
@@ -0,0 +1,9 @@
+-- Indexes for the hot queries. users.api_key (ux_users_api_key) and
+-- usage_logs (user_id, log_date) (user_date_unique) are already unique keys.
+USE bootstrapper;
+
+-- covers the usage counter load in ratelimit._load, so it never reads the table rows
+ALTER TABLE usage_logs ADD INDEX ix_usage_uid_date_counts (user_id, log_date, calls_today, projects_this_month);
+
+-- named index for list_presets; replaces the one InnoDB created implicitly for the foreign key
+ALTER TABLE presets ADD INDEX ix_presets_user (user_id);
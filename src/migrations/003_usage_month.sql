@@ -0,0 +1,8 @@
+-- Bucket usage rows by month so the monthly total is an equality lookup
+-- instead of an open-ended log_date range.
+USE bootstrapper;
+
+ALTER TABLE usage_logs
+    ADD COLUMN usage_month DATE AS (log_date - INTERVAL (DAY(log_date) - 1) DAY) STORED AFTER log_date,
+    ADD INDEX ix_usage_uid_month_counts (user_id, usage_month, log_date, calls_today, projects_this_month),
+    DROP INDEX ix_usage_uid_date_counts;
@@ -0,0 +1,7 @@
+-- Widen ix_presets_user so list_presets is answered from the index alone
+-- (InnoDB secondary indexes already carry the primary key, id).
+USE bootstrapper;
+
+ALTER TABLE presets
+    ADD INDEX ix_presets_user_list (user_id, name, template, git_init, use_venv, license_type),
+    DROP INDEX ix_presets_user;
@@ -0,0 +1,350 @@
+"""In-process usage counters backing the daily call and monthly project limits.
+
+Counts live in memory and their deltas are written to usage_logs by a background
+thread, so the limit checks on the request path do no database I/O. A user's
+counters are loaded from usage_logs the first time this process sees them.
+
+Calls are limited over a sliding window (24h by default) made of per-minute
+buckets, so a burst around midnight cannot spend two days' allowance at once.
+usage_logs keeps per-day totals; the buckets only exist in memory. When counters
+are (re)loaded, every stored day inside the window is counted, pinned to the last
+minute it could have happened (the end of that day, or now for today), so a
+restart can only make the limit stricter until those calls age out.
+
+When REDIS_URL is set the counters live in Redis instead, so every worker
+process enforces the same limits. Each check is a single script call (one round
+trip) and usage_logs is still fed by the background flush. Counters missing from
+Redis are reseeded from usage_logs whenever a check finds them gone.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+from db import get_conn
+
+try:
+    import redis
+except ImportError:  # optional, only needed when REDIS_URL is set
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '1'))
+USAGE_EVICT_INTERVAL = float(os.getenv('USAGE_EVICT_INTERVAL', '60'))
+CALL_WINDOW_MINUTES = int(os.getenv('API_RATE_LIMIT_WINDOW_MINUTES', '1440'))
+REDIS_URL = os.getenv('REDIS_URL')
+
+# KEYS[1] = hash of minute -> calls
+# ARGV = minute, cutoff minute, limit, ttl seconds, seeded flag, then [minute, calls] seed pairs.
+# Returns -1 without counting when the hash is missing and no seed was passed.
+_CALL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[5] ~= '1' then
+        return -1
+    end
+    for i = 6, #ARGV, 2 do
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+local cutoff = tonumber(ARGV[2])
+local total = 0
+local buckets = redis.call('HGETALL', KEYS[1])
+for i = 1, #buckets, 2 do
+    if tonumber(buckets[i]) <= cutoff then
+        redis.call('HDEL', KEYS[1], buckets[i])
+    else
+        total = total + tonumber(buckets[i + 1])
+    end
+end
+if total + 1 > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+# KEYS[1] = monthly project counter; ARGV = limit, ttl seconds, seeded flag, seed count.
+# Returns -1 without counting when the counter is missing and no seed was passed.
+_PROJECT_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if not count then
+    if ARGV[3] ~= '1' then
+        return -1
+    end
+    count = ARGV[4]
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[2])
+end
+if tonumber(count) + 1 > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+_MONTH_TTL = 32 * 86400
+
+
+def _calls_ttl() -> int:
+    # a reseed pins each stored day to its last minute, so the calls hash has to outlive the
+    # window by a day; expiring any sooner would reload calls that already left the window
+    return (CALL_WINDOW_MINUTES + 24 * 60) * 60 + 60
+
+
+class _Usage:
+    __slots__ = ('lock', 'loaded', 'last_seen', 'call_buckets', 'calls_in_window', 'month', 'projects_this_month')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.last_seen = None  # minute of the last check for this user
+        self.call_buckets = deque()  # [minute, count] pairs, oldest on the left
+        self.calls_in_window = 0
+        self.month = None
+        self.projects_this_month = 0
+
+
+_usage: Dict[int, _Usage] = {}
+_usage_lock = threading.Lock()
+# (user_id, log_date) -> [calls, projects] not yet written to usage_logs
+_pending: Dict[Tuple[int, date], List[int]] = {}
+_pending_lock = threading.Lock()
+_flusher = None
+_redis = None
+_redis_scripts = None
+
+
+def _load(user_id: int, today: date, minute: int) -> Tuple[List[List[int]], int]:
+    """Read a user's usage from usage_logs: ([minute, calls] buckets for the window, projects this month)."""
+    first_of_month = date(today.year, today.month, 1)
+    window_start = datetime.fromtimestamp((minute - CALL_WINDOW_MINUTES + 1) * 60).date()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT log_date, usage_month, calls_today, projects_this_month FROM usage_logs "
+                    "WHERE user_id=%s AND usage_month >= %s",
+                    (user_id, min(first_of_month, date(window_start.year, window_start.month, 1))))
+        rows = cur.fetchall()
+    projects = sum(r['projects_this_month'] or 0 for r in rows if r['usage_month'] == first_of_month)
+    # only per-day totals are stored, so pin each one to the latest minute it could have happened
+    buckets = sorted([min(_day_start_minute(r['log_date']) + 24 * 60 - 1, minute), r['calls_today']]
+                     for r in rows if r['log_date'] >= window_start and r['calls_today'])
+    return buckets, projects
+
+
+def _usage_for(user_id: int) -> _Usage:
+    with _usage_lock:
+        usage = _usage.get(user_id)
+        if usage is None:
+            usage = _usage[user_id] = _Usage()
+    return usage
+
+
+def _minute(ts: float) -> int:
+    return int(ts // 60)
+
+
+def _day_start_minute(today: date) -> int:
+    return _minute(datetime.combine(today, datetime.min.time()).timestamp())
+
+
+def _refresh(usage: _Usage, user_id: int, today: date, minute: int):
+    # caller holds usage.lock
+    month = (today.year, today.month)
+    if not usage.loaded:
+        buckets, usage.projects_this_month = _load(user_id, today, minute)
+        usage.call_buckets = deque(buckets)
+        usage.calls_in_window = sum(count for _, count in buckets)
+        usage.month = month
+        usage.loaded = True
+    usage.last_seen = minute
+    cutoff = minute - CALL_WINDOW_MINUTES
+    while usage.call_buckets and usage.call_buckets[0][0] <= cutoff:
+        usage.calls_in_window -= usage.call_buckets.popleft()[1]
+    if usage.month != month:
+        usage.month = month
+        usage.projects_this_month = 0
+
+
+def _record(user_id: int, for_date: date, calls: int, projects: int):
+    with _pending_lock:
+        delta = _pending.setdefault((user_id, for_date), [0, 0])
+        delta[0] += calls
+        delta[1] += projects
+
+
+def _get_redis_scripts():
+    global _redis, _redis_scripts
+    with _usage_lock:
+        if _redis is None:
+            if redis is None:
+                raise RuntimeError('REDIS_URL is set but the redis package is not installed')
+            client = redis.Redis.from_url(REDIS_URL)
+            _redis_scripts = (client.register_script(_CALL_SCRIPT), client.register_script(_PROJECT_SCRIPT))
+            _redis = client
+    return _redis_scripts
+
+
+def _calls_key(user_id: int) -> str:
+    return f"u:{user_id}:calls"
+
+
+def _projects_key(user_id: int, today: date) -> str:
+    return f"u:{user_id}:p:{today:%Y%m}"
+
+
+# The scripts refuse to count (-1) when a user's key is missing from Redis, whether on first use,
+# after expiry, eviction or a Redis restart. The counters are then read from usage_logs and passed
+# back in; the script only applies them if the key is still missing, so concurrent seeders cannot
+# double count.
+
+def _redis_call(user_id: int, today: date, minute: int, daily_limit: int) -> bool:
+    call_script = _get_redis_scripts()[0]
+    keys = [_calls_key(user_id)]
+    args = [minute, minute - CALL_WINDOW_MINUTES, daily_limit, _calls_ttl()]
+    result = call_script(keys=keys, args=args + [0])
+    if result == -1:
+        buckets, _ = _load(user_id, today, minute)
+        result = call_script(keys=keys, args=args + [1] + [value for bucket in buckets for value in bucket])
+    return result == 1
+
+
+def _redis_project(user_id: int, today: date, minute: int, month_limit: int) -> bool:
+    project_script = _get_redis_scripts()[1]
+    keys = [_projects_key(user_id, today)]
+    args = [month_limit, _MONTH_TTL]
+    result = project_script(keys=keys, args=args + [0])
+    if result == -1:
+        _, projects = _load(user_id, today, minute)
+        result = project_script(keys=keys, args=args + [1, projects])
+    return result == 1
+
+
+def _local_call(user_id: int, today: date, minute: int, daily_limit: int, load: bool) -> Optional[bool]:
+    usage = _usage_for(user_id)
+    with usage.lock:
+        if not usage.loaded and not load:
+            return None
+        _refresh(usage, user_id, today, minute)
+        if usage.calls_in_window + 1 > daily_limit:
+            return False
+        if usage.call_buckets and usage.call_buckets[-1][0] == minute:
+            usage.call_buckets[-1][1] += 1
+        else:
+            usage.call_buckets.append([minute, 1])
+        usage.calls_in_window += 1
+    return True
+
+
+def _local_project(user_id: int, today: date, minute: int, month_limit: int, load: bool) -> Optional[bool]:
+    usage = _usage_for(user_id)
+    with usage.lock:
+        if not usage.loaded and not load:
+            return None
+        _refresh(usage, user_id, today, minute)
+        if usage.projects_this_month + 1 > month_limit:
+            return False
+        usage.projects_this_month += 1
+    return True
+
+
+# With load=False the checks below never do I/O: they return None instead of True/False when
+# answering would mean reading usage_logs or asking Redis, and count nothing in that case.
+
+def increment_call_and_check_limit(user_id: int, daily_limit: int, load: bool = True) -> Optional[bool]:
+    today = date.today()
+    minute = _minute(time.time())
+    if REDIS_URL:
+        ok = _redis_call(user_id, today, minute, daily_limit) if load else None
+    else:
+        ok = _local_call(user_id, today, minute, daily_limit, load)
+    if ok:
+        _record(user_id, today, 1, 0)
+    return ok
+
+
+def increment_project_and_check_limit(user_id: int, month_limit: int, load: bool = True) -> Optional[bool]:
+    today = date.today()
+    if REDIS_URL:
+        ok = _redis_project(user_id, today, _minute(time.time()), month_limit) if load else None
+    else:
+        ok = _local_project(user_id, today, _minute(time.time()), month_limit, load)
+    if ok:
+        _record(user_id, today, 0, 1)
+    return ok
+
+
+def flush_usage():
+    """Write pending counter deltas to usage_logs; on failure they are kept for the next flush."""
+    global _pending
+    with _pending_lock:
+        if not _pending:
+            return
+        batch, _pending = _pending, {}
+    rows = [(user_id, for_date, calls, projects) for (user_id, for_date), (calls, projects) in batch.items()]
+    try:
+        with get_conn() as conn:
+            # one transaction, so a failed flush can be retried without double counting
+            conn.begin()
+            cur = conn.cursor()
+            cur.executemany("INSERT INTO usage_logs (user_id, log_date, calls_today, projects_this_month) VALUES (%s,%s,%s,%s) "
+                            "ON DUPLICATE KEY UPDATE calls_today=calls_today+VALUES(calls_today), "
+                            "projects_this_month=projects_this_month+VALUES(projects_this_month)", rows)
+            conn.commit()
+    except Exception:
+        for key, (calls, projects) in batch.items():
+            _record(key[0], key[1], calls, projects)
+        raise
+
+
+def evict_idle_usage():
+    """Forget users whose counters would be rebuilt from usage_logs unchanged.
+
+    These are users with no unflushed deltas and no check for a window plus a day.
+    A reload pins each stored day to its last minute, up to a day after the calls
+    really happened, so a user forgotten any sooner could be reloaded with calls
+    that had already left the window.
+    """
+    cutoff = _minute(time.time()) - CALL_WINDOW_MINUTES - 24 * 60
+    with _pending_lock:
+        pending_users = {user_id for user_id, _ in _pending}
+    with _usage_lock:
+        for user_id, usage in list(_usage.items()):
+            if user_id in pending_users or not usage.lock.acquire(blocking=False):
+                continue
+            try:
+                if not usage.loaded or usage.last_seen <= cutoff:
+                    # a request still holding this object reloads instead of counting on a forgotten entry
+                    usage.loaded = False
+                    del _usage[user_id]
+            finally:
+                usage.lock.release()
+
+
+def _flush_loop():
+    last_evict = time.monotonic()
+    while True:
+        time.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            flush_usage()
+        except Exception:
+            # the deltas were put back and go out with the next flush
+            logger.exception('usage flush failed, %d rows pending', len(_pending))
+        if time.monotonic() - last_evict >= USAGE_EVICT_INTERVAL:
+            last_evict = time.monotonic()
+            try:
+                evict_idle_usage()
+            except Exception:
+                logger.exception('usage eviction failed')
+
+
+def start_usage_flusher():
+    global _flusher
+    with _pending_lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name='usage-flusher', daemon=True)
+        _flusher.start()
@@ -5,19 +5,22 @@ CREATE TABLE IF NOT EXISTS users (
     id INT AUTO_INCREMENT PRIMARY KEY,
     username VARCHAR(50) NOT NULL UNIQUE,
     email VARCHAR(100) NOT NULL UNIQUE,
-    api_key CHAR(36) NOT NULL UNIQUE,
+    api_key BINARY(16) NOT NULL,
     tier ENUM('free','plus','pro') DEFAULT 'free',
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY ux_users_api_key (api_key)
 );
 
 CREATE TABLE IF NOT EXISTS usage_logs (
     id INT AUTO_INCREMENT PRIMARY KEY,
     user_id INT NOT NULL,
     log_date DATE NOT NULL,
+    usage_month DATE AS (log_date - INTERVAL (DAY(log_date) - 1) DAY) STORED,
     calls_today INT DEFAULT 0,
     projects_this_month INT DEFAULT 0,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-    UNIQUE KEY user_date_unique (user_id, log_date)
+    UNIQUE KEY user_date_unique (user_id, log_date),
+    KEY ix_usage_uid_month_counts (user_id, usage_month, log_date, calls_today, projects_this_month)
 );
 
 CREATE TABLE IF NOT EXISTS presets (
@@ -29,5 +32,6 @@ CREATE TABLE IF NOT EXISTS presets (
     use_venv BOOLEAN DEFAULT FALSE,
     license_type VARCHAR(50),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    KEY ix_presets_user_list (user_id, name, template, git_init, use_venv, license_type)
 );
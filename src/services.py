@@ -1,75 +1,81 @@
-from datetime import date, datetime
-from typing import Optional, Dict, Any
+from datetime import date, datetime, timezone
+from typing import Optional, Dict, Any, Tuple
 import json
+import os
+import threading
+import time
 from db import get_conn
+from utils import api_key_to_bytes
+
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '60'))
+USER_CACHE_MAX = int(os.getenv('USER_CACHE_MAX', '10000'))
+
+# api_key -> (expires_at, user row); only hits are cached
+_user_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_user_cache_lock = threading.Lock()
+
+# columns update_preset may set, in the order they appear in the UPDATE statement
+PRESET_UPDATE_COLUMNS = ('name', 'template', 'git_init', 'use_venv', 'license_type')
+
+
+def _db_now() -> datetime:
+    # what a DEFAULT CURRENT_TIMESTAMP column reads back as (naive UTC, second precision)
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
 
 
 def create_user(username: str, email: str, api_key: str, tier: str = 'free') -> Dict[str, Any]:
     with get_conn() as conn:
         cur = conn.cursor()
+        key_bytes = api_key_to_bytes(api_key)
         cur.execute("INSERT INTO users (username,email,api_key,tier) VALUES (%s,%s,%s,%s)",
-                    (username, email, api_key, tier))
-        conn.commit()
-        cur.execute("SELECT * FROM users WHERE api_key=%s", (api_key,))
-        return cur.fetchone()
+                    (username, email, key_bytes, tier))
+        # every column is already known here, no need to read the row back
+        return {'id': cur.lastrowid, 'username': username, 'email': email,
+                'api_key': api_key, 'tier': tier, 'created_at': _db_now()}
 
 
-def get_user_by_api_key(api_key: str) -> Optional[Dict[str, Any]]:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE api_key=%s", (api_key,))
-        return cur.fetchone()
+def _cache_user(api_key: str, user: Dict[str, Any], now: float):
+    with _user_cache_lock:
+        if api_key not in _user_cache and len(_user_cache) >= USER_CACHE_MAX:
+            for k in [k for k, (expires_at, _) in _user_cache.items() if expires_at <= now]:
+                del _user_cache[k]
+            if len(_user_cache) >= USER_CACHE_MAX:
+                # still full, drop the oldest entry
+                del _user_cache[next(iter(_user_cache))]
+        _user_cache[api_key] = (now + USER_CACHE_TTL, user)
 
 
-def ensure_usage_row(user_id: int, for_date: date):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM usage_logs WHERE user_id=%s AND log_date=%s", (user_id, for_date))
-        r = cur.fetchone()
-        if not r:
-            cur.execute("INSERT INTO usage_logs (user_id, log_date, calls_today, projects_this_month) VALUES (%s,%s,0,0)",
-                        (user_id, for_date))
-            conn.commit()
+def get_cached_user(api_key: str) -> Optional[Dict[str, Any]]:
+    """Return the user for api_key if it is in the cache and still fresh; never touches the database."""
+    with _user_cache_lock:
+        hit = _user_cache.get(api_key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
 
 
-def increment_call_and_check_limit(user_id: int, daily_limit: int) -> bool:
-    today = date.today()
+def get_user_by_api_key(api_key: str) -> Optional[Dict[str, Any]]:
+    user = get_cached_user(api_key)
+    if user:
+        return user
+    now = time.monotonic()
+    key_bytes = api_key_to_bytes(api_key)
+    if key_bytes is None:
+        return None
     with get_conn() as conn:
         cur = conn.cursor()
-        # ensure row exists
-        cur.execute("SELECT id,calls_today FROM usage_logs WHERE user_id=%s AND log_date=%s", (user_id, today))
-        r = cur.fetchone()
-        if not r:
-            cur.execute("INSERT INTO usage_logs (user_id, log_date, calls_today, projects_this_month) VALUES (%s,%s,1,0)", (user_id, today))
-            conn.commit()
-            return True
-        if r['calls_today'] + 1 > daily_limit:
-            return False
-        cur.execute("UPDATE usage_logs SET calls_today=calls_today+1 WHERE id=%s", (r['id'],))
-        conn.commit()
-        return True
-
-
-def increment_project_and_check_limit(user_id: int, month_limit: int) -> bool:
-    today = date.today()
-    first_of_month = date(today.year, today.month, 1)
+        cur.execute("SELECT id, tier FROM users WHERE api_key=%s", (key_bytes,))
+        user = cur.fetchone()
+    if user:
+        _cache_user(api_key, user, now)
+    return user
+
+
+def ensure_usage_row(user_id: int, for_date: date):
     with get_conn() as conn:
         cur = conn.cursor()
-        # sum projects_this_month for current month rows (we keep projects in single monthly counter per day rows)
-        cur.execute("SELECT SUM(projects_this_month) as total FROM usage_logs WHERE user_id=%s AND log_date >= %s", (user_id, first_of_month))
-        r = cur.fetchone()
-        total = r['total'] or 0
-        if total + 1 > month_limit:
-            return False
-        # increment today's row's projects_this_month
-        cur.execute("SELECT id FROM usage_logs WHERE user_id=%s AND log_date=%s", (user_id, today))
-        row = cur.fetchone()
-        if not row:
-            cur.execute("INSERT INTO usage_logs (user_id, log_date, calls_today, projects_this_month) VALUES (%s,%s,0,1)", (user_id, today))
-        else:
-            cur.execute("UPDATE usage_logs SET projects_this_month=projects_this_month+1 WHERE id=%s", (row['id'],))
-        conn.commit()
-        return True
+        cur.execute("INSERT INTO usage_logs (user_id, log_date, calls_today, projects_this_month) VALUES (%s,%s,0,0) "
+                    "ON DUPLICATE KEY UPDATE id=id", (user_id, for_date))
 
 
 def create_preset(user_id: int, name: str, template: str, git_init: bool, use_venv: bool, license_type: Optional[str]):
@@ -77,15 +83,17 @@ def create_preset(user_id: int, name: str, template: str, git_init: bool, use_ve
         cur = conn.cursor()
         cur.execute("INSERT INTO presets (user_id,name,template,git_init,use_venv,license_type) VALUES (%s,%s,%s,%s,%s,%s)",
                     (user_id, name, template, int(git_init), int(use_venv), license_type))
-        conn.commit()
-        cur.execute("SELECT * FROM presets WHERE id = LAST_INSERT_ID()")
-        return cur.fetchone()
+        return {'id': cur.lastrowid, 'user_id': user_id, 'name': name, 'template': template,
+                'git_init': int(git_init), 'use_venv': int(use_venv), 'license_type': license_type,
+                'created_at': _db_now()}
 
 
 def list_presets(user_id: int):
     with get_conn() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT * FROM presets WHERE user_id=%s", (user_id,))
+        # only the fields the API returns; ix_presets_user_list covers them
+        cur.execute("SELECT id, name, template, git_init, use_venv, license_type FROM presets WHERE user_id=%s",
+                    (user_id,))
         return cur.fetchall()
 
 
@@ -97,23 +105,23 @@ def get_preset(user_id: int, preset_id: int):
 
 
 def update_preset(user_id: int, preset_id: int, data: dict):
-    fields = []
-    values = []
-    for k, v in data.items():
-        fields.append(f"{k}=%s")
-        values.append(v)
-    values.extend([preset_id, user_id])
-    set_clause = ','.join(fields)
+    unknown = set(data) - set(PRESET_UPDATE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown preset fields: {', '.join(sorted(unknown))}")
+    # fixed column order, so the same set of fields always produces the same statement text
+    columns = [c for c in PRESET_UPDATE_COLUMNS if c in data]
+    if not columns:
+        return get_preset(user_id, preset_id)
+    set_clause = ','.join(f"{c}=%s" for c in columns)
+    values = [data[c] for c in columns] + [preset_id, user_id]
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute(f"UPDATE presets SET {set_clause} WHERE id=%s AND user_id=%s", tuple(values))
-        conn.commit()
-        return get_preset(user_id, preset_id)
+    return get_preset(user_id, preset_id)
 
 
 def delete_preset(user_id: int, preset_id: int):
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM presets WHERE id=%s AND user_id=%s", (preset_id, user_id))
-        conn.commit()
         return cur.rowcount > 0
\ No newline at end of file
@@ -1,29 +1,92 @@
-import os
-import shutil
-import tempfile
+import base64
+import functools
+import io
+import secrets
+import time
 import zipfile
 import uuid
-from pathlib import Path
+from typing import List, Optional, Tuple
 
 ALLOWED_FREE_TEMPLATES = {'flask', 'fastapi', 'basic-python'}
 
+# template -> (relative path, contents) pairs; '{name}' is replaced with the project name
+TEMPLATE_FILES = {
+    'basic-python': (
+        ('{name}/__init__.py', ''),
+        ('README.md', '# {name}\nGenerated by bootstrapper\n'),
+        ('main.py', 'print("Hello from generated project")'),
+    ),
+    'flask': (
+        ('{name}/app.py', 'from flask import Flask\napp = Flask(__name__)\n\n@app.route("/")\ndef home():\n    return "Hello, Flask!"\n'),
+        ('requirements.txt', 'flask'),
+    ),
+    'fastapi': (
+        ('app/main.py', 'from fastapi import FastAPI\napp=FastAPI()\n@app.get("/")\ndef root():\n    return {"msg":"Hello FastAPI"}'),
+        ('requirements.txt', 'fastapi\nuvicorn'),
+    ),
+}
 
-def create_zip_archive(folder_path: str) -> bytes:
-    tmp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-    with zipfile.ZipFile(tmp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zf:
-        folder_path = Path(folder_path)
-        for f in folder_path.rglob('*'):
-            if f.is_file():
-                # exclude virtualenv and git
-                if '.git' in f.parts or 'venv' in f.parts:
-                    continue
-                arcname = f.relative_to(folder_path)
-                zf.write(f, arcname)
-    with open(tmp_zip.name, 'rb') as fh:
-        data = fh.read()
-    os.unlink(tmp_zip.name)
-    return data
+
+def render_template(template: str, name: str) -> List[Tuple[str, str]]:
+    """Return the (relative path, contents) pairs of a project generated from template."""
+    return [(path.replace('{name}', name), content.replace('{name}', name))
+            for path, content in TEMPLATE_FILES[template]]
+
+
+def _zip_info(path: str) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(path, date_time=time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o644 << 16
+    return zinfo
+
+
+def _depends_on_name(path: str, content: str) -> bool:
+    return '{name}' in path or '{name}' in content
+
+
+@functools.lru_cache(maxsize=8)
+def _template_base_zip(template: str) -> bytes:
+    # the part of a template's archive that is the same for every project name
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path, content in TEMPLATE_FILES[template]:
+            if not _depends_on_name(path, content):
+                zf.writestr(_zip_info(path), content)
+    return archive.getvalue()
+
+
+def build_project_zip(template: str, name: str) -> bytes:
+    """Return the zip for a project generated from template, reusing the cached name-independent part."""
+    archive = io.BytesIO(_template_base_zip(template))
+    with zipfile.ZipFile(archive, 'a', zipfile.ZIP_DEFLATED) as zf:
+        for path, content in TEMPLATE_FILES[template]:
+            if _depends_on_name(path, content):
+                zf.writestr(_zip_info(path.replace('{name}', name)), content.replace('{name}', name))
+    return archive.getvalue()
 
 
 def generate_api_key() -> str:
-    return str(uuid.uuid4())
\ No newline at end of file
+    # 16 random bytes, handed to the client as unpadded base64url (22 chars)
+    return base64.urlsafe_b64encode(secrets.token_bytes(16)).rstrip(b'=').decode('ascii')
+
+
+def api_key_to_bytes(api_key: str) -> Optional[bytes]:
+    """Decode a client supplied API key to the 16 bytes stored in users.api_key, or None if malformed.
+
+    Keys issued before the switch to random bytes are UUID strings; they map to the UUID's bytes.
+    """
+    if len(api_key) == 36:
+        try:
+            return uuid.UUID(api_key).bytes
+        except ValueError:
+            return None
+    if len(api_key) == 22:
+        try:
+            raw = base64.urlsafe_b64decode(api_key + '==')
+        except ValueError:
+            return None
+        # reject non-canonical spellings (the last char carries 4 unused bits)
+        if len(raw) != 16 or base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii') != api_key:
+            return None
+        return raw
+    return None
\ No newline at end of file
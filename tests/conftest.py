@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app modules import each other as top-level modules (see railway.json: uvicorn main:app)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
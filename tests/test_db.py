@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+
+import db
+
+
+class FakeConnection:
+    def __init__(self):
+        self.open = True
+        self.pings = 0
+        self.ping_error = None
+
+    def ping(self):
+        self.pings += 1
+        if self.ping_error:
+            raise self.ping_error
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """Run the pool against fake connections; returns every connection it opened."""
+    opened = []
+
+    def connect(**kwargs):
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(db.mysql_driver, 'connect', connect)
+    monkeypatch.setattr(db, '_pool', None)
+    monkeypatch.setattr(db, '_created', 0)
+    monkeypatch.setattr(db, '_overflow', 0)
+    monkeypatch.setattr(db, '_waiting', 0)
+    monkeypatch.setattr(db, 'POOL_MIN', 0)
+    monkeypatch.setattr(db, 'POOL_MAX', 2)
+    monkeypatch.setattr(db, 'POOL_MAX_OVERFLOW', 2)
+    monkeypatch.setattr(db, 'POOL_REAP_INTERVAL', 3600)
+    return opened
+
+
+def test_pool_grows_on_demand_up_to_pool_max(opened):
+    with db.get_conn() as first:
+        with db.get_conn() as second:
+            assert first is not second
+            assert db.pool_stats()['size'] == 2
+    assert len(opened) == 2
+    assert db.pool_stats()['idle'] == 2
+
+
+def test_pool_hands_out_most_recently_released_connection(opened):
+    with db.get_conn() as first:
+        with db.get_conn() as second:
+            pass
+    # second went back first, so first sits on top of the stack
+    with db.get_conn() as conn:
+        assert conn is first
+    with db.get_conn() as conn:
+        with db.get_conn() as other:
+            assert other is second
+    assert len(opened) == 2
+
+
+def test_closed_connection_is_dropped_and_pool_regrows(opened):
+    with db.get_conn() as conn:
+        conn.open = False
+    assert db.pool_stats()['size'] == 0
+    with db.get_conn() as conn:
+        assert conn is opened[1]
+
+
+def _age_idle_connections(seconds):
+    db._pool = type(db._pool)((conn, last_used - seconds) for conn, last_used in db._pool)
+
+
+def test_connection_idle_past_timeout_is_replaced(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_IDLE_TIMEOUT', 60)
+    with db.get_conn() as stale:
+        pass
+    _age_idle_connections(61)
+    with db.get_conn() as conn:
+        assert conn is not stale
+    assert not stale.open
+    assert db.pool_stats()['size'] == 1
+
+
+def test_connection_idle_past_ping_after_is_pinged_and_reused(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_IDLE_TIMEOUT', 60)
+    monkeypatch.setattr(db, 'POOL_PING_AFTER', 30)
+    with db.get_conn() as first:
+        pass
+    _age_idle_connections(31)
+    with db.get_conn() as conn:
+        assert conn is first
+    assert first.pings == 1
+
+
+def test_connection_failing_ping_is_replaced(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_IDLE_TIMEOUT', 60)
+    monkeypatch.setattr(db, 'POOL_PING_AFTER', 30)
+    with db.get_conn() as dead:
+        dead.ping_error = OSError('gone away')
+    _age_idle_connections(31)
+    with db.get_conn() as conn:
+        assert conn is not dead
+    assert db.pool_stats()['size'] == 1
+
+
+def test_overflow_connection_is_closed_on_release(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_MAX', 1)
+    monkeypatch.setattr(db, 'POOL_MAX_OVERFLOW', 2)
+    monkeypatch.setattr(db, 'POOL_TIMEOUT', 0.01)
+    with db.get_conn() as pooled:
+        with db.get_conn() as extra:
+            assert db.pool_stats() == {'size': 1, 'idle': 0, 'in_use': 2, 'overflow': 1, 'waiting': 0}
+            # POOL_MAX_OVERFLOW caps the total, pooled connections included
+            with pytest.raises(db.PoolTimeout):
+                with db.get_conn():
+                    pass
+        assert not extra.open
+    assert pooled.open
+    assert db.pool_stats() == {'size': 1, 'idle': 1, 'in_use': 0, 'overflow': 0, 'waiting': 0}
+
+
+def test_exhausted_pool_raises_pool_timeout(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_MAX', 1)
+    monkeypatch.setattr(db, 'POOL_MAX_OVERFLOW', 1)
+    monkeypatch.setattr(db, 'POOL_TIMEOUT', 0.01)
+    with db.get_conn():
+        with pytest.raises(db.PoolTimeout):
+            with db.get_conn():
+                pass
+    assert db.pool_stats()['waiting'] == 0
+    assert len(opened) == 1
+
+
+def test_waiter_gets_released_connection(opened, monkeypatch):
+    monkeypatch.setattr(db, 'POOL_MAX', 1)
+    monkeypatch.setattr(db, 'POOL_MAX_OVERFLOW', 1)
+    monkeypatch.setattr(db, 'POOL_TIMEOUT', 5)
+    got = []
+
+    def waiter():
+        with db.get_conn() as conn:
+            got.append(conn)
+
+    with db.get_conn() as held:
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while db.pool_stats()['waiting'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.001)
+    thread.join(5)
+    assert got == [held]
+    assert len(opened) == 1
@@ -0,0 +1,307 @@
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import ratelimit
+
+_load = ratelimit._load
+START = 1_700_000_000.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Local limiter with an empty usage_logs and a settable wall clock and date."""
+    now = [START]
+
+    class Date(date):
+        @classmethod
+        def today(cls):
+            return cls.fromtimestamp(now[0])
+
+    monkeypatch.setattr(ratelimit, 'time', SimpleNamespace(time=lambda: now[0], monotonic=time.monotonic))
+    monkeypatch.setattr(ratelimit, 'date', Date)
+    monkeypatch.setattr(ratelimit, 'REDIS_URL', None)
+    monkeypatch.setattr(ratelimit, 'CALL_WINDOW_MINUTES', 1440)
+    monkeypatch.setattr(ratelimit, '_usage', {})
+    monkeypatch.setattr(ratelimit, '_pending', {})
+    monkeypatch.setattr(ratelimit, '_load', lambda user_id, today, minute: ([], 0))
+    return now
+
+
+def test_calls_over_the_limit_are_denied(clock):
+    assert [ratelimit.increment_call_and_check_limit(1, 3) for _ in range(4)] == [True, True, True, False]
+    # denied calls are not counted
+    assert ratelimit._usage[1].calls_in_window == 3
+
+
+def test_calls_are_allowed_again_once_they_leave_the_window(clock):
+    for _ in range(3):
+        assert ratelimit.increment_call_and_check_limit(1, 3)
+    clock[0] = START + 1439 * 60
+    assert not ratelimit.increment_call_and_check_limit(1, 3)
+    clock[0] = START + 1440 * 60
+    assert ratelimit.increment_call_and_check_limit(1, 3)
+    assert ratelimit._usage[1].calls_in_window == 1
+
+
+def test_window_slides_per_minute_bucket(clock):
+    assert ratelimit.increment_call_and_check_limit(1, 2)
+    clock[0] = START + 600
+    assert ratelimit.increment_call_and_check_limit(1, 2)
+    # only the first bucket has left the window
+    clock[0] = START + 1440 * 60
+    assert ratelimit.increment_call_and_check_limit(1, 2)
+    assert not ratelimit.increment_call_and_check_limit(1, 2)
+
+
+def test_loaded_calls_count_against_the_window(clock, monkeypatch):
+    minute = ratelimit._minute(START)
+    monkeypatch.setattr(ratelimit, '_load', lambda user_id, today, m: ([[minute - 10, 3]], 0))
+    assert not ratelimit.increment_call_and_check_limit(1, 3)
+    clock[0] = START + (1440 - 10) * 60
+    assert ratelimit.increment_call_and_check_limit(1, 3)
+
+
+def test_calls_are_queued_for_flush(clock):
+    ratelimit.increment_call_and_check_limit(1, 3)
+    ratelimit.increment_call_and_check_limit(1, 3)
+    assert ratelimit._pending == {(1, ratelimit.date.today()): [2, 0]}
+
+
+def test_load_pins_stored_days_to_their_latest_minute(monkeypatch):
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    rows = [
+        {'log_date': yesterday, 'usage_month': yesterday.replace(day=1), 'calls_today': 7, 'projects_this_month': 2},
+        {'log_date': today, 'usage_month': today.replace(day=1), 'calls_today': 1, 'projects_this_month': 1},
+    ]
+
+    class Cursor:
+        def execute(self, sql, args):
+            pass
+
+        def fetchall(self):
+            return rows
+
+    @contextmanager
+    def get_conn():
+        yield SimpleNamespace(cursor=Cursor)
+
+    monkeypatch.setattr(ratelimit, 'get_conn', get_conn)
+    monkeypatch.setattr(ratelimit, 'CALL_WINDOW_MINUTES', 1440)
+    now = ratelimit._minute(time.time())
+    buckets, projects = ratelimit._load(1, today, now)
+    assert buckets == [[ratelimit._day_start_minute(yesterday) + 24 * 60 - 1, 7], [now, 1]]
+    assert projects == (3 if yesterday.month == today.month else 1)
+
+
+class UsageLogs:
+    """usage_logs as {(user_id, log_date): [calls, projects]}, behind the statements ratelimit runs."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.rows = {}
+        self.user_id = None
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def cursor(self):
+        return self
+
+    def executemany(self, sql, rows):
+        if self.fail:
+            raise RuntimeError('database unavailable')
+        for user_id, log_date, calls, projects in rows:
+            row = self.rows.setdefault((user_id, log_date), [0, 0])
+            row[0] += calls
+            row[1] += projects
+
+    def execute(self, sql, args):
+        self.user_id = args[0]
+
+    def fetchall(self):
+        return [{'log_date': log_date, 'usage_month': log_date.replace(day=1),
+                 'calls_today': calls, 'projects_this_month': projects}
+                for (user_id, log_date), (calls, projects) in self.rows.items() if user_id == self.user_id]
+
+
+def _use_connection(monkeypatch, conn):
+    @contextmanager
+    def get_conn():
+        yield conn
+
+    monkeypatch.setattr(ratelimit, 'get_conn', get_conn)
+
+
+def test_flush_writes_pending_deltas(clock, monkeypatch):
+    logs = UsageLogs()
+    _use_connection(monkeypatch, logs)
+    ratelimit.increment_call_and_check_limit(1, 3)
+    ratelimit.increment_project_and_check_limit(1, 3)
+    ratelimit.flush_usage()
+    assert logs.rows == {(1, ratelimit.date.today()): [1, 1]}
+    assert ratelimit._pending == {}
+
+
+def test_failed_flush_keeps_deltas_for_the_next_one(clock, monkeypatch):
+    _use_connection(monkeypatch, UsageLogs(fail=True))
+    ratelimit.increment_call_and_check_limit(1, 3)
+    with pytest.raises(RuntimeError):
+        ratelimit.flush_usage()
+    ratelimit.increment_call_and_check_limit(1, 3)
+    assert ratelimit._pending == {(1, ratelimit.date.today()): [2, 0]}
+
+
+def test_evict_forgets_only_idle_flushed_users(clock):
+    ratelimit.increment_call_and_check_limit(1, 3)
+    ratelimit.increment_call_and_check_limit(2, 3)
+    ratelimit._pending.clear()
+    ratelimit._record(2, ratelimit.date.today(), 1, 0)
+    clock[0] = START + (1440 + 24 * 60) * 60
+    ratelimit.increment_call_and_check_limit(3, 3)
+    ratelimit.evict_idle_usage()
+    # 2 still has an unflushed delta and 3 has calls in the window
+    assert set(ratelimit._usage) == {2, 3}
+
+
+def test_evicted_user_is_not_reloaded_into_the_window(clock, monkeypatch):
+    logs = UsageLogs()
+    _use_connection(monkeypatch, logs)
+    monkeypatch.setattr(ratelimit, '_load', _load)
+    day = ratelimit.date.today()
+    clock[0] = datetime.combine(day, dt_time(8)).timestamp()
+    for _ in range(10):
+        assert ratelimit.increment_call_and_check_limit(1, 10)
+    ratelimit.flush_usage()
+    # the next morning the calls have left the window; the stored total would pin them to 23:59
+    clock[0] = datetime.combine(day + timedelta(days=1), dt_time(8, 1)).timestamp()
+    ratelimit.evict_idle_usage()
+    assert 1 in ratelimit._usage
+    clock[0] += 60
+    assert ratelimit.increment_call_and_check_limit(1, 10)
+    ratelimit.flush_usage()
+    # idle for a window plus a day: everything stored has aged out, so the reload is exact
+    clock[0] = datetime.combine(day + timedelta(days=3), dt_time(8, 3)).timestamp()
+    ratelimit.evict_idle_usage()
+    assert 1 not in ratelimit._usage
+    assert ratelimit.increment_call_and_check_limit(1, 10)
+    assert ratelimit._usage[1].calls_in_window == 1
+
+
+@pytest.fixture
+def fake_redis(clock, monkeypatch):
+    """Redis backed limiter on fakeredis; returns the client the scripts run on."""
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    monkeypatch.setattr(ratelimit, 'REDIS_URL', 'redis://localhost:6379/0')
+    monkeypatch.setattr(ratelimit, 'redis', SimpleNamespace(Redis=fakeredis.FakeRedis))
+    monkeypatch.setattr(ratelimit, '_redis', None)
+    monkeypatch.setattr(ratelimit, '_redis_scripts', None)
+    ratelimit._get_redis_scripts()
+    # clients for the same URL share one fake server
+    ratelimit._redis.flushall()
+    return ratelimit._redis
+
+
+def _expire(client, seconds):
+    # fakeredis expires on the real clock; drop whatever would have expired after seconds
+    for key in client.keys():
+        if client.ttl(key) <= seconds:
+            client.delete(key)
+
+
+def test_redis_calls_over_the_limit_are_denied(fake_redis):
+    assert [ratelimit.increment_call_and_check_limit(1, 3) for _ in range(4)] == [True, True, True, False]
+    assert fake_redis.hgetall(ratelimit._calls_key(1)) == {str(ratelimit._minute(START)).encode(): b'3'}
+
+
+def test_redis_drops_buckets_that_left_the_window(fake_redis, clock):
+    ratelimit.increment_call_and_check_limit(1, 3)
+    clock[0] = START + 1440 * 60
+    assert ratelimit.increment_call_and_check_limit(1, 3)
+    assert list(fake_redis.hgetall(ratelimit._calls_key(1))) == [str(ratelimit._minute(clock[0])).encode()]
+
+
+def test_redis_reseeds_missing_counters_from_usage_logs(fake_redis, monkeypatch):
+    loads = []
+    minute = ratelimit._minute(START)
+
+    def load(user_id, today, m):
+        loads.append(user_id)
+        return [[minute - 10, 2]], 4
+
+    monkeypatch.setattr(ratelimit, '_load', load)
+    assert ratelimit.increment_call_and_check_limit(1, 3)
+    assert not ratelimit.increment_call_and_check_limit(1, 3)
+    assert ratelimit.increment_project_and_check_limit(1, 5)
+    assert not ratelimit.increment_project_and_check_limit(1, 5)
+    assert len(loads) == 2
+    # lost keys (expiry, eviction, a Redis restart) are read back instead of starting from zero
+    fake_redis.flushall()
+    assert [ratelimit.increment_call_and_check_limit(1, 3) for _ in range(2)] == [True, False]
+    assert [ratelimit.increment_project_and_check_limit(1, 5) for _ in range(2)] == [True, False]
+    assert len(loads) == 4
+
+
+def test_redis_seed_is_ignored_once_the_key_exists(fake_redis):
+    call_script, project_script = ratelimit._redis_scripts
+    minute = ratelimit._minute(START)
+    key = ratelimit._calls_key(1)
+    # a second seeder racing the first must not add the stored calls again
+    assert call_script(keys=[key], args=[minute, minute - 1440, 10, 60, 1, minute - 5, 3]) == 1
+    assert call_script(keys=[key], args=[minute, minute - 1440, 10, 60, 1, minute - 5, 3]) == 1
+    assert fake_redis.hgetall(key) == {str(minute - 5).encode(): b'3', str(minute).encode(): b'2'}
+    key = ratelimit._projects_key(1, date.today())
+    assert project_script(keys=[key], args=[10, 60, 1, 4]) == 1
+    assert project_script(keys=[key], args=[10, 60, 1, 4]) == 1
+    assert fake_redis.get(key) == b'6'
+
+
+def test_redis_counters_outlive_the_window_by_a_day(fake_redis, clock, monkeypatch):
+    logs = UsageLogs()
+    _use_connection(monkeypatch, logs)
+    monkeypatch.setattr(ratelimit, '_load', _load)
+    day = ratelimit.date.today()
+    clock[0] = start = datetime.combine(day, dt_time(8)).timestamp()
+    for _ in range(10):
+        assert ratelimit.increment_call_and_check_limit(1, 10)
+    ratelimit.flush_usage()
+    # the next morning the stored total would pin the calls to 23:59 if the hash were reseeded
+    clock[0] = datetime.combine(day + timedelta(days=1), dt_time(8, 2)).timestamp()
+    _expire(fake_redis, clock[0] - start)
+    assert ratelimit.increment_call_and_check_limit(1, 10)
+
+
+def test_checks_without_load_never_read_usage_logs(clock, monkeypatch):
+    def load(user_id, today, minute):
+        raise AssertionError('usage_logs read')
+
+    monkeypatch.setattr(ratelimit, '_load', load)
+    assert ratelimit.increment_call_and_check_limit(1, 3, load=False) is None
+    assert ratelimit.increment_project_and_check_limit(1, 3, load=False) is None
+    assert ratelimit._pending == {}
+
+
+def test_checks_without_load_answer_for_loaded_users_until_evicted(clock):
+    assert ratelimit.increment_call_and_check_limit(1, 1)
+    assert ratelimit.increment_call_and_check_limit(1, 1, load=False) is False
+    assert ratelimit.increment_project_and_check_limit(1, 1, load=False) is True
+    evicted = ratelimit._usage[1]
+    ratelimit._pending.clear()
+    clock[0] = START + (1440 + 24 * 60) * 60
+    ratelimit.evict_idle_usage()
+    assert ratelimit.increment_call_and_check_limit(1, 1, load=False) is None
+    # a check still holding the evicted entry sees it as unloaded too
+    assert not evicted.loaded
+
+
+def test_redis_checks_without_load_defer_to_the_caller(fake_redis):
+    assert ratelimit.increment_call_and_check_limit(1, 3, load=False) is None
+    assert fake_redis.keys() == []
@@ -0,0 +1,56 @@
+import base64
+import io
+import uuid
+import zipfile
+
+import utils
+
+
+def test_generated_api_key_round_trips():
+    key = utils.generate_api_key()
+    assert len(key) == 22
+    raw = utils.api_key_to_bytes(key)
+    assert len(raw) == 16
+    assert base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii') == key
+
+
+def test_uuid_api_key_maps_to_uuid_bytes():
+    key = uuid.uuid4()
+    assert utils.api_key_to_bytes(str(key)) == key.bytes
+
+
+def test_non_canonical_api_key_is_rejected():
+    canonical = base64.urlsafe_b64encode(bytes(16)).rstrip(b'=').decode('ascii')
+    assert utils.api_key_to_bytes(canonical) == bytes(16)
+    # 'B' only differs from 'A' in the 4 padding bits of the last character
+    assert utils.api_key_to_bytes(canonical[:-1] + 'B') is None
+
+
+def test_malformed_api_keys_are_rejected():
+    for key in ('', 'abc', 'x' * 36, 'é' * 22, '!' * 22, utils.generate_api_key() + 'A'):
+        assert utils.api_key_to_bytes(key) is None
+
+
+def _read_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        return {name: zf.read(name).decode() for name in zf.namelist()}
+
+
+def test_project_zip_matches_rendered_template():
+    for template in utils.TEMPLATE_FILES:
+        for name in ('first', 'second'):
+            files = _read_zip(utils.build_project_zip(template, name))
+            assert files == dict(utils.render_template(template, name))
+
+
+def test_project_zip_fills_in_the_name():
+    files = _read_zip(utils.build_project_zip('basic-python', 'demo'))
+    assert 'demo/__init__.py' in files
+    assert files['README.md'].startswith('# demo\n')
+
+
+def test_project_zip_reuses_cached_base_without_leaking_names():
+    utils.build_project_zip('flask', 'one')
+    files = _read_zip(utils.build_project_zip('flask', 'two'))
+    assert sorted(files) == ['requirements.txt', 'two/app.py']